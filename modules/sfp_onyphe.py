@@ -11,15 +11,24 @@
 # Licence:     GPL
 # -------------------------------------------------------------------------------
 
+import calendar
+import hashlib
 import json
+import threading
 import time
-from datetime import datetime
+import urllib.parse
+from collections import defaultdict
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from spiderfoot import SpiderFootEvent, SpiderFootPlugin
 
 
 class sfp_onyphe(SpiderFootPlugin):
 
+    BASE_URL = "https://www.onyphe.io/api/v2"
+
     meta = {
         "name": "Onyphe",
         "summary": "Check Onyphe data (threat list, geo-location, pastries, vulnerabilities)  about a given IP.",
@@ -56,6 +65,9 @@ class sfp_onyphe(SpiderFootPlugin):
         "max_page": 10,
         "verify": True,
         "age_limit_days": 30,
+        "cacheperiod": 24,
+        "_maxthreads": 3,
+        "_maxdnsthreads": 16,
     }
     optdescs = {
         "api_key": "Onyphe access token.",
@@ -63,18 +75,51 @@ class sfp_onyphe(SpiderFootPlugin):
         "max_page": "Maximum number of pages to iterate through. Onyphe has a maximum of 1000 pages (10,000 results). Only matters for paid plans",
         "verify": "Verify identified domains still resolve to the associated specified IP address.",
         "age_limit_days": "Ignore any records older than this many days. 0 = unlimited.",
+        "cacheperiod": "Hours to cache Onyphe results before re-fetching. 0 = no caching.",
+        "_maxthreads": "Maximum concurrent requests per Onyphe endpoint. Keep this low, as hitting the Onyphe rate limit stops the module.",
+        "_maxdnsthreads": "Maximum concurrent DNS lookups when verifying domains.",
     }
 
     results = None
     errorState = False
+    session = None
+    headers = None
+    pendingEvents = None
+    ageLimitTs = 0
 
     def setup(self, sfc, userOpts=dict()):
         self.sf = sfc
         self.results = self.tempStorage()
+        self.pendingEvents = list()
 
         for opt in list(userOpts.keys()):
             self.opts[opt] = userOpts[opt]
 
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"apikey {self.opts['api_key']}",
+            "Accept-Encoding": "gzip, deflate",
+        }
+
+        # Keep connections to Onyphe alive between requests. Each of the four
+        # endpoints can have up to _maxthreads pages in flight, so size the
+        # pool to match rather than have urllib3 drop the extra connections.
+        self.session = self.sf.getSession()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=4 * self.opts["_maxthreads"],
+                # Only retry connection errors; a 429 is left to queryPage()
+                max_retries=Retry(
+                    total=2,
+                    backoff_factor=0.3,
+                    status_forcelist=(),
+                    respect_retry_after_header=False,
+                ),
+            ),
+        )
+
     # What events is this module interested in for input
     def watchedEvents(self):
         return ["IP_ADDRESS", "IPV6_ADDRESS"]
@@ -92,18 +137,31 @@ class sfp_onyphe(SpiderFootPlugin):
             "PHYSICAL_COORDINATES",
         ]
 
-    def query(self, endpoint, ip, page=1):
-        retarr = list()
+    def queryUrl(self, endpoint, ip, page):
+        limit = self.opts["age_limit_days"]
+
+        # Paid plans can use the search API to have Onyphe drop old records
+        # before sending them, rather than paging through them only for
+        # isFreshEnough() to discard them
+        if self.opts["paid_plan"] and limit > 0:
+            q = urllib.parse.quote(f"category:{endpoint} ip:{ip} -since:{limit}d")
+            return f"{self.BASE_URL}/search/?q={q}&page={page}"
+
+        return f"{self.BASE_URL}/simple/{endpoint}/{ip}?page={page}"
+
+    def queryPage(self, endpoint, ip, page):
+        # Another endpoint or page may already have hit a rate limit or bad
+        # API key, in which case this request would fail the same way
+        if self.errorState:
+            return None
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"apikey {self.opts['api_key']}",
-        }
         res = self.sf.fetchUrl(
-            f"https://www.onyphe.io/api/v2/simple/{endpoint}/{ip}?page={page}",
+            self.queryUrl(endpoint, ip, page),
             timeout=self.opts["_fetchtimeout"],
             useragent=self.opts["_useragent"],
-            headers=headers,
+            headers=self.headers,
+            session=self.session,
+            dontMangle=True,
         )
 
         if res["code"] == "429":
@@ -111,11 +169,12 @@ class sfp_onyphe(SpiderFootPlugin):
             self.errorState = True
             return None
 
-        if res["code"] == 400:
+        if res["code"] == "400":
             self.sf.error("Invalid request or API key on Onyphe", False)
             self.errorState = True
             return None
 
+        # json.loads() accepts the raw bytes, so skip decoding the body first
         try:
             info = json.loads(res["content"])
             if "status" in info and info["status"] == "nok":
@@ -133,46 +192,170 @@ class sfp_onyphe(SpiderFootPlugin):
             self.sf.error("Error processing JSON response from Onyphe.", False)
             return None
 
+        return info
+
+    def query(self, endpoint, ip):
+        # The URL carries the search filter; the plan and page limit decide
+        # how many pages are fetched
+        url = self.queryUrl(endpoint, ip, 1)
+        cacheLabel = f"sfp_onyphe_{url}_{self.opts['paid_plan']}_{self.opts['max_page']}"
+
+        if self.opts["cacheperiod"] > 0:
+            cached = self.sf.cacheGet(cacheLabel, self.opts["cacheperiod"])
+            if cached:
+                self.sf.debug(f"Using cached Onyphe {endpoint} data for {ip}")
+                return json.loads(cached)
+
+        retarr = self.queryPages(endpoint, ip)
+        if retarr is None:
+            return None
+
+        # A page that failed to come back leaves a gap. Use the pages we have,
+        # but only cache complete results.
+        complete = None not in retarr and not self.errorState
+        retarr = [info for info in retarr if info is not None]
+
+        if complete and self.opts["cacheperiod"] > 0:
+            self.sf.cachePut(cacheLabel, json.dumps(retarr))
+
+        # Drop stale records here, so handleEvent() never has to look at them
+        if retarr and self.opts["age_limit_days"] > 0:
+            for info in retarr:
+                info["results"] = [
+                    result
+                    for result in info["results"]
+                    if self.isFreshEnough(result.get("@timestamp"))
+                ]
+            retarr = [info for info in retarr if info["results"]]
+
+        return retarr or None
+
+    def queryPages(self, endpoint, ip):
+        info = self.queryPage(endpoint, ip, 1)
+        if info is None:
+            return None
+
+        retarr = [info]
+
         # Go through other pages if user has paid plan
+        if not self.opts["paid_plan"]:
+            return retarr
+
         try:
-            current_page = int(info["page"])
-            if (
-                self.opts["paid_plan"]
-                and info.get("page")
-                and int(info.get("max_page")) > current_page
-            ):
-                page = current_page + 1
-
-                if page > self.opts["max_page"]:
-                    self.sf.error(
-                        "Maximum number of pages from options for Onyphe reached.",
-                        False,
-                    )
-                    return [info]
-                retarr.append(info)
-                response = self.query(endpoint, ip, page)
-                if response:
-                    retarr.extend(response)
-            else:
-                retarr.append(info)
+            last_page = int(info.get("max_page"))
+        except (TypeError, ValueError):
+            self.sf.error(
+                f"Unexpected value for page in response from Onyphe, url: {self.queryUrl(endpoint, ip, 1)}",
+                False,
+            )
+            return retarr
 
-        except ValueError:
+        if last_page > self.opts["max_page"]:
             self.sf.error(
-                f"Unexpected value for page in response from Onyphe, url: https://www.onyphe.io/api/v2/simple/{endpoint}/{ip}?page={page}",
+                "Maximum number of pages from options for Onyphe reached.",
                 False,
             )
-            self.errorState = True
-            return None
+            last_page = self.opts["max_page"]
+
+        # The number of pages is known up front, so fetch the rest concurrently.
+        # Pages that could not be fetched are left as None for query() to spot.
+        pages = range(2, last_page + 1)
+        retarr.extend(
+            self.threadCalls(self.queryPage, [(endpoint, ip, page) for page in pages])
+        )
 
         return retarr
 
+    def threadCalls(self, func, argsList, maxThreads=None):
+        """Call func once for each argument tuple, running up to maxThreads
+        calls at a time in their own threads.
+
+        Args:
+            func (function): function to call
+            argsList (list): argument tuples to call func with
+            maxThreads (int): maximum concurrent calls, defaults to _maxthreads
+
+        Returns:
+            list: return values of func, in the same order as argsList. A call
+            that raised an exception leaves None in its place.
+        """
+        results = [None] * len(argsList)
+
+        def worker(i, args):
+            # Exceptions don't leave the thread, so report them here rather
+            # than lose them
+            try:
+                results[i] = func(*args)
+            except Exception as e:
+                self.sf.error(
+                    f"Onyphe {func.__name__}{args} failed: {e.__class__.__name__}: {e}",
+                    False,
+                )
+
+        if maxThreads is None:
+            maxThreads = self.opts["_maxthreads"]
+
+        for start in range(0, len(argsList), maxThreads):
+            threads = list()
+            for i in range(start, min(start + maxThreads, len(argsList))):
+                t = threading.Thread(
+                    name=f"thread_sfp_onyphe_{i}",
+                    target=worker,
+                    args=(i, argsList[i]),
+                )
+                t.start()
+                threads.append(t)
+
+            # Block until all threads in this batch are finished
+            for t in threads:
+                t.join()
+
+        return results
+
+    def iterResults(self, dataArr):
+        """Yield the records from every page of a query() response, one page
+        at a time, stopping early if the scan has been aborted.
+
+        Args:
+            dataArr (list): pages returned by query()
+
+        Yields:
+            dict: Onyphe record
+        """
+        for data in dataArr:
+            if self.checkForStop():
+                return
+
+            yield from data["results"]
+
+    def queueEvent(self, eventType, data, event):
+        """Queue an event to be sent to listeners on the next flushEvents().
+
+        Args:
+            eventType (str): event type
+            data (str): event data
+            event (SpiderFootEvent): source event
+        """
+        self.pendingEvents.append(
+            SpiderFootEvent(eventType, data, self.__name__, event)
+        )
+
+    def flushEvents(self):
+        """Send all queued events to listeners."""
+        # Listeners can feed new IPs back into handleEvent() while we are
+        # notifying them, so take the queue before walking it
+        events = self.pendingEvents
+        self.pendingEvents = list()
+
+        for evt in events:
+            self.notifyListeners(evt)
+
     def emitLocationEvent(self, location, eventData, event):
         if location is None:
             return
         self.sf.info(f"Found location for {eventData}: {location}")
 
-        evt = SpiderFootEvent("PHYSICAL_COORDINATES", location, self.__name__, event)
-        self.notifyListeners(evt)
+        self.queueEvent("PHYSICAL_COORDINATES", location, event)
 
     def emitDomainData(self, response, eventData, event):
         domains = set()
@@ -185,210 +368,187 @@ class sfp_onyphe(SpiderFootPlugin):
             for subDomain in response["subdomains"]:
                 domains.add(subDomain)
 
-        for domain in domains:
-            if self.opts["verify"] and not self.sf.resolveHost(domain):
+        domains = list(domains)
+
+        # Resolve all the domains at once rather than one after the other
+        if self.opts["verify"]:
+            resolved = self.threadCalls(
+                self.sf.resolveHost,
+                [(domain,) for domain in domains],
+                self.opts["_maxdnsthreads"],
+            )
+        else:
+            resolved = [True] * len(domains)
+
+        for domain, addrs in zip(domains, resolved):
+            # resolveHost() always returns a list, so None means the lookup
+            # raised and we can't say whether the domain resolves
+            if addrs is None:
+                continue
+
+            if not addrs:
                 self.sf.debug(f"Host {domain} could not be resolved for {eventData}")
-                evt = SpiderFootEvent(
-                    "INTERNET_NAME_UNRESOLVED", domain, self.__name__, event
-                )
-                self.notifyListeners(evt)
+                self.queueEvent("INTERNET_NAME_UNRESOLVED", domain, event)
             else:
-                evt = SpiderFootEvent("INTERNET_NAME", domain, self.__name__, event)
-                self.notifyListeners(evt)
+                self.queueEvent("INTERNET_NAME", domain, event)
 
-    def isFreshEnough(self, result):
+    def isFreshEnough(self, timestamp):
         limit = self.opts["age_limit_days"]
         if limit <= 0:
             return True
 
-        timestamp = result.get("@timestamp")
         if timestamp is None:
             self.sf.debug("Record doesn't have timestamp defined")
             return False
 
-        last_dt = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-        last_ts = int(time.mktime(last_dt.timetuple()))
-        age_limit_ts = int(time.time()) - (86400 * limit)
+        # Onyphe timestamps are UTC, e.g. 2020-08-21T13:37:00.000Z
+        try:
+            last_ts = calendar.timegm(
+                (
+                    int(timestamp[0:4]),
+                    int(timestamp[5:7]),
+                    int(timestamp[8:10]),
+                    int(timestamp[11:13]),
+                    int(timestamp[14:16]),
+                    int(timestamp[17:19]),
+                )
+            )
+        except (TypeError, ValueError):
+            self.sf.debug(f"Record has an invalid timestamp: {timestamp}")
+            return False
 
-        if last_ts < age_limit_ts:
+        if last_ts < self.ageLimitTs:
             self.sf.debug("Record found but too old, skipping.")
             return False
 
         return True
 
-    # Handle events sent to this module
-    def handleEvent(self, event):
-        eventName = event.eventType
-        srcModuleName = event.module
-        eventData = event.data
-        sentData = set()
+    def emitGeoLocResult(self, result, eventData, event, sentData):
+        city = result.get("city")
+        country = result.get("country")
+        coordinates = result.get("location")
 
-        if self.errorState:
-            return None
+        location = ", ".join([_f for _f in [city, country] if _f])
+        if location:
+            self.sf.info("Found GeoIP for " + eventData + ": " + location)
 
-        self.sf.debug("Received event, %s, from %s" % (eventName, srcModuleName))
+            if location in sentData["GEOINFO"]:
+                self.sf.debug(f"Skipping {location}, already sent")
+                return
 
-        if self.opts["api_key"] == "":
-            self.sf.error("You enabled sfp_onyphe, but did not set an API key!", False)
-            self.errorState = True
-            return None
+            sentData["GEOINFO"].add(location)
 
-        # Don't look up stuff twice
-        if eventData in self.results:
-            self.sf.debug("Skipping " + eventData + " as already mapped.")
-            return None
+            self.queueEvent("GEOINFO", location, event)
 
-        self.results[eventData] = True
-
-        geoLocDataArr = self.query("geoloc", eventData)
-
-        if geoLocDataArr is not None:
-            evt = SpiderFootEvent(
-                "RAW_RIR_DATA", str(geoLocDataArr), self.__name__, event
-            )
-            self.notifyListeners(evt)
-
-            for geoLocData in geoLocDataArr:
-                if self.checkForStop():
-                    return None
-
-                for result in geoLocData["results"]:
-                    if not self.isFreshEnough(result):
-                        continue
-
-                    location = ", ".join(
-                        [
-                            _f
-                            for _f in [
-                                result.get("city"),
-                                result.get("country"),
-                            ]
-                            if _f
-                        ]
-                    )
-                    self.sf.info("Found GeoIP for " + eventData + ": " + location)
-
-                    if location in sentData:
-                        self.sf.debug(f"Skipping {location}, already sent")
-                        continue
+        if coordinates is None:
+            return
 
-                    sentData.add(location)
+        if coordinates in sentData["PHYSICAL_COORDINATES"]:
+            self.sf.debug(f"Skipping {coordinates}, already sent")
+            return
+        sentData["PHYSICAL_COORDINATES"].add(coordinates)
 
-                    evt = SpiderFootEvent("GEOINFO", location, self.__name__, event)
-                    self.notifyListeners(evt)
+        self.emitLocationEvent(coordinates, eventData, event)
 
-                    coordinates = result.get("location")
-                    if coordinates is None:
-                        continue
+        self.emitDomainData(result, eventData, event)
 
-                    if coordinates in sentData:
-                        self.sf.debug(f"Skipping {coordinates}, already sent")
-                        continue
-                    sentData.add(coordinates)
+    def emitPastryResult(self, result, eventData, event, sentData):
+        pastry = result.get("content")
+        if pastry is None:
+            return
 
-                    self.emitLocationEvent(coordinates, eventData, event)
+        # Pastries can be large, so only remember a digest of each
+        pastryDigest = hashlib.blake2b(
+            pastry.encode("utf-8", errors="replace"), digest_size=16
+        ).digest()
+        if pastryDigest in sentData["LEAKSITE_CONTENT"]:
+            self.sf.debug("Skipping pastry, already sent")
+            return
+        sentData["LEAKSITE_CONTENT"].add(pastryDigest)
 
-                    self.emitDomainData(result, eventData, event)
+        self.queueEvent("LEAKSITE_CONTENT", pastry, event)
 
-        pastriesDataArr = self.query("pastries", eventData)
+    def emitThreatListResult(self, result, eventData, event, sentData):
+        threatList = result.get("threatlist")
 
-        if pastriesDataArr is not None:
-            evt = SpiderFootEvent(
-                "RAW_RIR_DATA", str(pastriesDataArr), self.__name__, event
-            )
-            self.notifyListeners(evt)
-
-            for pastriesData in pastriesDataArr:
-                if self.checkForStop():
-                    return None
-
-                for result in pastriesData["results"]:
-                    pastry = result.get("content")
-                    if pastry is None:
-                        continue
+        if threatList is None:
+            return
 
-                    if pastry in sentData:
-                        self.sf.debug(f"Skipping {pastry}, already sent")
-                        continue
-                    sentData.add(pastry)
+        if threatList in sentData["MALICIOUS_IPADDR"]:
+            self.sf.debug(f"Skipping {threatList}, already sent")
+            return
+        sentData["MALICIOUS_IPADDR"].add(threatList)
 
-                    if not self.isFreshEnough(result):
-                        continue
+        self.queueEvent("MALICIOUS_IPADDR", threatList, event)
 
-                    evt = SpiderFootEvent(
-                        "LEAKSITE_CONTENT", pastry, self.__name__, event
-                    )
-                    self.notifyListeners(evt)
+    def emitVulnerabilityResult(self, result, eventData, event, sentData):
+        cves = result.get("cve")
 
-        threatListDataArr = self.query("threatlist", eventData)
+        if cves is None:
+            return
 
-        if threatListDataArr is not None:
-            evt = SpiderFootEvent(
-                "RAW_RIR_DATA", str(threatListDataArr), self.__name__, event
-            )
-            self.notifyListeners(evt)
+        # Records often list the same CVEs, possibly in another order
+        cveKey = tuple(sorted(cve for cve in cves if cve))
+        if not cveKey:
+            return
 
-            for threatListData in threatListDataArr:
-                if self.checkForStop():
-                    return None
+        if cveKey in sentData["VULNERABILITY"]:
+            self.sf.debug(f"Skipping {cveKey}, already sent")
+            return
+        sentData["VULNERABILITY"].add(cveKey)
 
-                for result in threatListData["results"]:
-                    threatList = result.get("threatlist")
+        self.queueEvent("VULNERABILITY", ", ".join(cveKey), event)
 
-                    if threatList is None:
-                        continue
+    # Handle events sent to this module
+    def handleEvent(self, event):
+        eventName = event.eventType
+        srcModuleName = event.module
+        eventData = event.data
 
-                    if threatList in sentData:
-                        self.sf.debug(f"Skipping {threatList}, already sent")
-                        continue
-                    sentData.add(threatList)
+        # Keep a separate set per event type, so e.g. a pastry can't suppress
+        # a threat list of the same name
+        sentData = defaultdict(set)
 
-                    if not self.isFreshEnough(result):
-                        continue
+        if self.errorState:
+            return None
 
-                    evt = SpiderFootEvent(
-                        "MALICIOUS_IPADDR",
-                        result.get("threatlist"),
-                        self.__name__,
-                        event,
-                    )
-                    self.notifyListeners(evt)
+        self.sf.debug("Received event, %s, from %s" % (eventName, srcModuleName))
 
-        vulnerabilityDataArr = self.query("vulnscan", eventData)
+        if self.opts["api_key"] == "":
+            self.sf.error("You enabled sfp_onyphe, but did not set an API key!", False)
+            self.errorState = True
+            return None
 
-        if vulnerabilityDataArr is not None:
-            evt = SpiderFootEvent(
-                "RAW_RIR_DATA", str(vulnerabilityDataArr), self.__name__, event
-            )
-            self.notifyListeners(evt)
+        # Don't look up stuff twice
+        if eventData in self.results:
+            self.sf.debug("Skipping " + eventData + " as already mapped.")
+            return None
 
-            for vulnerabilityData in vulnerabilityDataArr:
-                if self.checkForStop():
-                    return None
+        self.results[eventData] = True
 
-                for result in vulnerabilityData["results"]:
-                    cves = result.get("cve")
+        self.ageLimitTs = int(time.time()) - (86400 * self.opts["age_limit_days"])
 
-                    if cves is None:
-                        continue
+        endpoints = [
+            ("geoloc", self.emitGeoLocResult),
+            ("pastries", self.emitPastryResult),
+            ("threatlist", self.emitThreatListResult),
+            ("vulnscan", self.emitVulnerabilityResult),
+        ]
 
-                    cveData = ", ".join([cve for cve in cves if cve])
+        # The endpoints are independent, so query them all at once
+        dataArrs = self.threadCalls(
+            self.query, [(endpoint, eventData) for endpoint, _ in endpoints]
+        )
 
-                    if cveData in sentData:
-                        self.sf.debug(f"Skipping {cveData}, already sent")
-                        continue
-                    sentData.add(cveData)
+        for (endpoint, emitResult), dataArr in zip(endpoints, dataArrs):
+            if dataArr is None:
+                continue
 
-                    if not self.isFreshEnough(result):
-                        continue
+            self.queueEvent("RAW_RIR_DATA", json.dumps(dataArr), event)
 
-                    evt = SpiderFootEvent(
-                        "VULNERABILITY",
-                        cveData,
-                        self.__name__,
-                        event,
-                    )
-                    self.notifyListeners(evt)
+            for result in self.iterResults(dataArr):
+                emitResult(result, eventData, event, sentData)
 
+            self.flushEvents()
 
 # End of sfp_onyphe class
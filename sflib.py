@@ -2492,8 +2492,12 @@ class SpiderFoot:
     def fetchUrl(self, url, fatal=False, cookies=None, timeout=30,
                  useragent="SpiderFoot", headers=None, noLog=False,
                  postData=None, dontMangle=False, sizeLimit=None,
-                 headOnly=False, verify=True):
-        """Fetch a URL, return the response object."""
+                 headOnly=False, verify=True, session=None):
+        """Fetch a URL, return the response object.
+
+        A requests session can be supplied to re-use its connections
+        across calls, otherwise a new session is created for each fetch.
+        """
 
         if not url:
             return None
@@ -2519,6 +2523,9 @@ class SpiderFoot:
         else:
             self.debug(f"Not using proxy for {url}")
 
+        if session is None:
+            session = self.getSession()
+
         try:
             header = dict()
             btime = time.time()
@@ -2539,7 +2546,7 @@ class SpiderFoot:
                 if not noLog:
                     self.info(f"Fetching (HEAD only): {self.removeUrlCreds(url)} [user-agent: {header['User-Agent']}] [timeout: {timeout}]")
 
-                hdr = self.getSession().head(
+                hdr = session.head(
                     url,
                     headers=header,
                     proxies=proxies,
@@ -2565,7 +2572,7 @@ class SpiderFoot:
                     if not noLog:
                         self.info(f"Fetching (HEAD only): {self.removeUrlCreds(url)} [user-agent: {header['User-Agent']}] [timeout: {timeout}]")
 
-                    hdr = self.getSession().head(
+                    hdr = session.head(
                         result['realurl'],
                         headers=header,
                         proxies=proxies,
@@ -2587,7 +2594,7 @@ class SpiderFoot:
 
             try:
                 if postData:
-                    res = self.getSession().post(
+                    res = session.post(
                         url,
                         data=postData,
                         headers=header,
@@ -2598,7 +2605,7 @@ class SpiderFoot:
                         verify=verify
                     )
                 else:
-                    res = self.getSession().get(
+                    res = session.get(
                         url,
                         headers=header,
                         proxies=proxies,
@@ -2636,7 +2643,8 @@ class SpiderFoot:
                 self.debug("Refresh header found, re-directing to " + self.removeUrlCreds(newurl))
                 return self.fetchUrl(newurl, fatal, cookies, timeout,
                                      useragent, headers, noLog, postData,
-                                     dontMangle, sizeLimit, headOnly)
+                                     dontMangle, sizeLimit, headOnly,
+                                     session=session)
 
             result['realurl'] = res.url
             result['code'] = str(res.status_code)
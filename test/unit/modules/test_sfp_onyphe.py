@@ -1,5 +1,8 @@
 # test_sfp_onyphe.py
+import json
+import time
 import unittest
+from collections import defaultdict
 
 from modules.sfp_onyphe import sfp_onyphe
 from sflib import SpiderFoot
@@ -78,3 +81,199 @@ class TestModuleOnyphe(unittest.TestCase):
 
         self.assertIsNone(result)
         self.assertTrue(module.errorState)
+
+    def test_isFreshEnough_should_compare_utc_timestamp_against_age_limit(self):
+        """
+        Test isFreshEnough(self, timestamp)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(module.opts, age_limit_days=30)
+        module.ageLimitTs = int(time.time()) - (86400 * 30)
+
+        recent = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(time.time() - 86400))
+        old = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(time.time() - 86400 * 31))
+
+        self.assertTrue(module.isFreshEnough(recent))
+        self.assertFalse(module.isFreshEnough(old))
+
+    def test_isFreshEnough_invalid_timestamp_should_return_false(self):
+        """
+        Test isFreshEnough(self, timestamp)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(module.opts, age_limit_days=30)
+        module.ageLimitTs = int(time.time()) - (86400 * 30)
+
+        invalid_types = [None, "", "not a timestamp", 12345]
+        for invalid_type in invalid_types:
+            with self.subTest(invalid_type=invalid_type):
+                self.assertFalse(module.isFreshEnough(invalid_type))
+
+    def test_queryUrl_should_use_search_api_for_paid_plan_with_age_limit(self):
+        """
+        Test queryUrl(self, endpoint, ip, page)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+
+        module.opts = dict(module.opts, paid_plan=True, age_limit_days=30)
+        url = module.queryUrl("geoloc", "1.2.3.4", 2)
+        self.assertTrue(url.startswith("https://www.onyphe.io/api/v2/search/?q="))
+        self.assertIn("-since%3A30d", url)
+        self.assertTrue(url.endswith("&page=2"))
+
+        module.opts = dict(module.opts, paid_plan=True, age_limit_days=0)
+        url = module.queryUrl("geoloc", "1.2.3.4", 2)
+        self.assertEqual(url, "https://www.onyphe.io/api/v2/simple/geoloc/1.2.3.4?page=2")
+
+        module.opts = dict(module.opts, paid_plan=False, age_limit_days=30)
+        url = module.queryUrl("geoloc", "1.2.3.4", 1)
+        self.assertEqual(url, "https://www.onyphe.io/api/v2/simple/geoloc/1.2.3.4?page=1")
+
+    def test_emitVulnerabilityResult_should_dedupe_cves_regardless_of_order(self):
+        """
+        Test emitVulnerabilityResult(self, result, eventData, event, sentData)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+
+        event = SpiderFootEvent('ROOT', 'example data', '', '')
+        sentData = defaultdict(set)
+
+        module.emitVulnerabilityResult({"cve": ["CVE-2020-2", "CVE-2020-1"]}, 'example data', event, sentData)
+        module.emitVulnerabilityResult({"cve": ["CVE-2020-1", "CVE-2020-2"]}, 'example data', event, sentData)
+        module.emitVulnerabilityResult({"cve": []}, 'example data', event, sentData)
+
+        self.assertEqual(len(module.pendingEvents), 1)
+        self.assertEqual(module.pendingEvents[0].eventType, "VULNERABILITY")
+        self.assertEqual(module.pendingEvents[0].data, "CVE-2020-1, CVE-2020-2")
+
+    def test_query_paid_plan_should_return_pages_in_order_up_to_max_page(self):
+        """
+        Test query(self, endpoint, ip)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(
+            module.opts, paid_plan=True, max_page=3, age_limit_days=0, cacheperiod=0,
+            _fetchtimeout=5, _useragent='SpiderFoot'
+        )
+
+        requested = list()
+
+        def fetchUrl(url, **kwargs):
+            page = int(url.split("page=")[1])
+            requested.append(page)
+            return {'code': "200", 'content': json.dumps({'results': [{'page': page}], 'page': page, 'max_page': 5})}
+
+        sf.fetchUrl = fetchUrl
+
+        result = module.query("geoloc", "1.2.3.4")
+
+        self.assertEqual([info['page'] for info in result], [1, 2, 3])
+        self.assertEqual(sorted(requested), [1, 2, 3])
+
+    def test_query_with_failed_page_should_not_cache_results(self):
+        """
+        Test query(self, endpoint, ip)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(
+            module.opts, paid_plan=True, max_page=3, age_limit_days=0, cacheperiod=24,
+            _fetchtimeout=5, _useragent='SpiderFoot'
+        )
+
+        cached = list()
+
+        def fetchUrl(url, **kwargs):
+            page = int(url.split("page=")[1])
+            if page == 2:
+                return {'code': None, 'content': None}
+            return {'code': "200", 'content': json.dumps({'results': [{'page': page}], 'page': page, 'max_page': 3})}
+
+        sf.fetchUrl = fetchUrl
+        sf.cacheGet = lambda label, timeoutHrs: None
+        sf.cachePut = lambda label, data: cached.append(label)
+
+        result = module.query("geoloc", "1.2.3.4")
+
+        self.assertEqual([info['page'] for info in result], [1, 3])
+        self.assertEqual(cached, [])
+
+    def test_query_with_cache_hit_should_not_fetch(self):
+        """
+        Test query(self, endpoint, ip)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(
+            module.opts, paid_plan=True, max_page=3, age_limit_days=0, cacheperiod=24,
+            _fetchtimeout=5, _useragent='SpiderFoot'
+        )
+
+        requested = list()
+
+        def fetchUrl(url, **kwargs):
+            requested.append(url)
+            return {'code': None, 'content': None}
+
+        cachedData = [{'results': [{'city': 'example city'}], 'page': 1, 'max_page': 1}]
+
+        sf.fetchUrl = fetchUrl
+        sf.cacheGet = lambda label, timeoutHrs: json.dumps(cachedData)
+        sf.cachePut = lambda label, data: None
+
+        result = module.query("geoloc", "1.2.3.4")
+
+        self.assertEqual(result, cachedData)
+        self.assertEqual(requested, [])
+
+    def test_query_after_rate_limit_should_not_send_further_requests(self):
+        """
+        Test query(self, endpoint, ip)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        module = sfp_onyphe()
+        module.setup(sf, dict())
+        module.opts = dict(
+            module.opts, paid_plan=True, max_page=5, age_limit_days=0, cacheperiod=0,
+            _maxthreads=1, _fetchtimeout=5, _useragent='SpiderFoot'
+        )
+
+        requested = list()
+
+        def fetchUrl(url, **kwargs):
+            page = int(url.split("page=")[1])
+            requested.append(page)
+            if page == 2:
+                return {'code': "429", 'content': None}
+            return {'code': "200", 'content': json.dumps({'results': [{'page': page}], 'page': page, 'max_page': 5})}
+
+        sf.fetchUrl = fetchUrl
+
+        module.query("geoloc", "1.2.3.4")
+
+        self.assertTrue(module.errorState)
+        self.assertEqual(requested, [1, 2])
+
+        self.assertIsNone(module.query("pastries", "1.2.3.4"))
+        self.assertEqual(requested, [1, 2])
+
@@ -1459,6 +1459,20 @@ class TestSpiderFoot(unittest.TestCase):
         self.assertEqual(res['code'], "301")
         self.assertEqual(res['content'], None)
 
+    def test_fetchUrl_argument_session_should_return_http_response_as_dict(self):
+        """
+        Test fetchUrl(self, url, fatal=False, cookies=None, timeout=30,
+                 useragent="SpiderFoot", headers=None, noLog=False,
+                 postData=None, dontMangle=False, sizeLimit=None,
+                 headOnly=False, verify=False, session=None)
+        """
+        sf = SpiderFoot(self.default_options)
+
+        res = sf.fetchUrl("https://spiderfoot.net/", session=sf.getSession())
+        self.assertIsInstance(res, dict)
+        self.assertEqual(res['code'], "200")
+        self.assertNotEqual(res['content'], None)
+
     def test_fetchUrl_argument_url_invalid_type_should_return_none(self):
         """
         Test fetchUrl(self, url, fatal=False, cookies=None, timeout=30,